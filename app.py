@@ -1,13 +1,13 @@
 import streamlit as st
 import json
 import os
-import sys
 import re
+import tempfile
+import threading
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-from datetime import datetime
-from io import StringIO
+from datetime import datetime, timedelta
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
@@ -66,6 +66,22 @@ AVAILABLE_GROUPS = [
     '4.1', '4.2', '5.1', '5.2', '6.1', '6.2'
 ]
 
+SOURCE_URL = "https://poweron.loe.lviv.ua/"
+SCHEDULE_FILE = 'schedule.json'
+
+# Скільки кешовані дані вважаються свіжими
+CACHE_TTL = timedelta(minutes=15)
+# Після цього часу "завислий" скрапер не блокує нову спробу оновлення
+REVALIDATION_TIMEOUT = timedelta(minutes=2)
+# Обмеження на завантаження сторінки, менше за REVALIDATION_TIMEOUT,
+# щоб зависле завантаження не займало слот оновлення
+PAGE_LOAD_TIMEOUT = timedelta(seconds=60)
+# Наскільки час сайту може випереджати наш годинник, щоб не вважати
+# графік опублікованим учора
+SOURCE_CLOCK_TOLERANCE = timedelta(hours=1)
+# Як часто сторінка перевіряє, чи з'явились нові дані у файлі
+FRESHNESS_CHECK_INTERVAL = timedelta(seconds=30)
+
 
 # ──────────────────────────────────────────────
 # Допоміжні функції
@@ -76,7 +92,8 @@ def make_all_power_on_data():
     now = datetime.now(ZoneInfo("Europe/Kyiv"))
     return {
         "update_time": now.strftime("%H:%M"),
-        "schedules": {group: [] for group in AVAILABLE_GROUPS}
+        "schedules": {group: [] for group in AVAILABLE_GROUPS},
+        "fallback": True
     }
 
 
@@ -100,6 +117,7 @@ def get_dynamic_html(url):
 
     driver = webdriver.Chrome(options=chrome_options)
     try:
+        driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT.total_seconds())
         driver.get(url)
         # Чекаємо лише на body — щоб відрізнити мережеву помилку від зміни верстки
         WebDriverWait(driver, 15).until(
@@ -179,6 +197,285 @@ def min_to_time(m):
     return f"{int(m // 60):02d}:{int(m % 60):02d}"
 
 
+# ──────────────────────────────────────────────
+# Кеш і свіжість даних (stale-while-revalidate)
+# ──────────────────────────────────────────────
+
+def fetch_schedule_data():
+    """Завантаження та парсинг графіка з сайту.
+
+    Повертає пару (data, error). Для справжніх даних error — None,
+    а до даних додається мітка fetched_at — момент, коли ми їх отримали
+    (на відміну від update_time, який публікує сам сайт). Фолбек
+    мітки не отримує, бо це не дані з сайту.
+    """
+    html = get_dynamic_html(SOURCE_URL)
+    if html is None:
+        return make_all_power_on_data(), "Сайт недоступний"
+
+    data = parse_html_to_data(html)
+    if data.get("fallback"):
+        return data, "Не вдалося розібрати сторінку сайту"
+
+    data["fetched_at"] = datetime.now(ZoneInfo("Europe/Kyiv")).isoformat(timespec="seconds")
+    return data, None
+
+
+def save_schedule_data(data):
+    """Атомарний запис даних у файл, щоб читачі не бачили напівзаписаний JSON.
+
+    Кожен запис іде в окремий тимчасовий файл, тож паралельні оновлення
+    не псують один одному дані.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(SCHEDULE_FILE)),
+        prefix=f"{os.path.basename(SCHEDULE_FILE)}.", suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, SCHEDULE_FILE)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load_schedule_data():
+    """Читання кешованих даних з файлу.
+
+    Повертає None, якщо файлу немає. Якщо у файлі немає fetched_at
+    (старий формат або фолбек), час отримання вважається невідомим.
+    """
+    if not os.path.exists(SCHEDULE_FILE):
+        return None
+
+    with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    data.setdefault("fetched_at", None)
+    return data
+
+
+@st.cache_resource
+def get_revalidation_state():
+    """Спільний для всіх сесій стан фонового оновлення."""
+    return {
+        "lock": threading.Lock(),
+        "started_at": None,
+        "token": None,
+        "last_error": None,
+        "failed_at": None,
+    }
+
+
+def _revalidate(state, token):
+    """Фонове оновлення кешу. Не використовує st.*, бо працює поза сесією."""
+    error = "Оновлення перервано"
+    try:
+        data, error = fetch_schedule_data()
+        with state["lock"]:
+            # Спробу, яку вже замінила новіша, не записуємо: вона могла б
+            # перезаписати свіжіші дані старішими.
+            # Фолбеком ніколи не перезаписуємо наявний кеш: краще показати старі
+            # дані (позначені як застарілі). Фолбек пишемо лише коли кешу немає.
+            if state["token"] is token and (
+                error is None or not os.path.exists(SCHEDULE_FILE)
+            ):
+                save_schedule_data(data)
+    except Exception as e:
+        # Повний текст (у Selenium — багаторядковий, зі стеком) не показуємо
+        error = f"Помилка під час оновлення ({type(e).__name__})"
+    finally:
+        with state["lock"]:
+            # Якщо ця спроба вже вважається завислою і її замінила нова —
+            # не чіпаємо стан нової спроби.
+            if state["token"] is token:
+                state["started_at"] = None
+                state["token"] = None
+                state["last_error"] = error
+                state["failed_at"] = datetime.now(ZoneInfo("Europe/Kyiv")) if error else None
+
+
+def start_revalidation(force=False):
+    """Запуск фонового оновлення, якщо воно ще не виконується.
+
+    Після невдалої спроби наступна автоматична відкладається на
+    REVALIDATION_TIMEOUT; force=True (кнопка у бічній панелі) це ігнорує.
+    Повертає True, якщо оновлення було запущене цим викликом.
+    """
+    state = get_revalidation_state()
+    now = datetime.now(ZoneInfo("Europe/Kyiv"))
+
+    with state["lock"]:
+        started_at = state["started_at"]
+        if started_at is not None and now - started_at < REVALIDATION_TIMEOUT:
+            return False
+        failed_at = state["failed_at"]
+        if not force and failed_at is not None and now - failed_at < REVALIDATION_TIMEOUT:
+            return False
+        token = object()
+        state["started_at"] = now
+        state["token"] = token
+
+    threading.Thread(target=_revalidate, args=(state, token), daemon=True).start()
+    return True
+
+
+def get_source_age(update_time, fetched_at):
+    """Вік графіка на сайті (update_time) на момент отримання (fetched_at).
+
+    Сайт публікує лише години й хвилини, тому час, пізніший за момент
+    отримання більш ніж на SOURCE_CLOCK_TOLERANCE, означає, що графік
+    опубліковано в один з попередніх днів. Менше випередження — це
+    розбіжність годинників, і вік тоді дорівнює нулю.
+    Повертає пару (age, from_previous_day) або (None, False).
+    """
+    try:
+        h, m = map(int, update_time.split(':'))
+        published_at = fetched_at.replace(hour=h, minute=m, second=0, microsecond=0)
+    except (AttributeError, TypeError, ValueError):
+        return None, False
+
+    if published_at - fetched_at > SOURCE_CLOCK_TOLERANCE:
+        return fetched_at - (published_at - timedelta(days=1)), True
+    return max(fetched_at - published_at, timedelta(0)), False
+
+
+def get_freshness(data):
+    """Оцінка свіжості кешованих даних.
+
+    Дані застарілі, якщо вони старші за CACHE_TTL, час їх отримання
+    невідомий або некоректний, або це фолбек, а не дані з сайту.
+    """
+    state = get_revalidation_state()
+    with state["lock"]:
+        is_revalidating = state["started_at"] is not None
+        last_error = state["last_error"]
+
+    freshness = {
+        "fetched_at": None,
+        "age_seconds": None,
+        "source_update_time": None,
+        "source_age_seconds": None,
+        "source_from_previous_day": False,
+        "is_fallback": bool(data and data.get("fallback")),
+        "is_stale": True,
+        "is_revalidating": is_revalidating,
+        "last_error": last_error,
+    }
+
+    if data is None:
+        return freshness
+
+    freshness["fetched_at"] = data.get("fetched_at")
+    if freshness["is_fallback"]:
+        return freshness
+
+    freshness["source_update_time"] = data.get("update_time")
+
+    try:
+        fetched_at = datetime.fromisoformat(data.get("fetched_at"))
+        age = datetime.now(ZoneInfo("Europe/Kyiv")) - fetched_at
+    except (TypeError, ValueError):
+        # Немає мітки, вона пошкоджена або без часового поясу
+        return freshness
+
+    fetched_at = fetched_at.astimezone(ZoneInfo("Europe/Kyiv"))
+    source_age, from_previous_day = get_source_age(data.get("update_time"), fetched_at)
+
+    freshness["age_seconds"] = int(age.total_seconds())
+    freshness["is_stale"] = age > CACHE_TTL
+    if source_age is not None:
+        freshness["source_age_seconds"] = int(source_age.total_seconds())
+        freshness["source_from_previous_day"] = from_previous_day
+
+    return freshness
+
+
+def get_schedule():
+    """Видача кешованих даних одразу, з фоновим оновленням після TTL.
+
+    Читач ніколи не чекає на скрапер: якщо дані застаріли або відсутні,
+    запускається фонове оновлення, а повертаються наявні дані.
+    """
+    data = load_schedule_data()
+    freshness = get_freshness(data)
+
+    if freshness["is_stale"] and start_revalidation():
+        freshness["is_revalidating"] = True
+
+    return data, freshness
+
+
+def format_age(seconds):
+    """Людський формат віку даних."""
+    minutes = seconds // 60
+    if minutes < 1:
+        return "щойно"
+    if minutes < 60:
+        return f"{minutes} хв тому"
+    return f"{minutes // 60} год {minutes % 60} хв тому"
+
+
+def data_signature(data):
+    """Ознаки, за якими сторінка помічає, що у файлі з'явились інші дані."""
+    if data is None:
+        return None
+    return data.get("fetched_at"), bool(data.get("fallback"))
+
+
+def render_freshness(data, freshness):
+    """Індикатор свіжості: update_time — час сайту, fetched_at — наш."""
+    if freshness["is_revalidating"]:
+        next_step = "Оновлення виконується у фоні, сторінка оновиться автоматично."
+    elif freshness["last_error"]:
+        next_step = f"Останнє оновлення не вдалося: {freshness['last_error']}."
+    else:
+        next_step = "Оновлення буде запущено найближчим часом."
+
+    if data is None:
+        st.warning(f"⚠️ Файл з даними не знайдено. {next_step}")
+        return
+
+    if not freshness["is_stale"]:
+        st.caption(f"✅ Дані актуальні: отримано {format_age(freshness['age_seconds'])}")
+    elif freshness["is_fallback"]:
+        st.warning(
+            "⚠️ Дані з сайту отримати не вдалося. "
+            f"Припускаємо, що електроенергія є у всіх групах. {next_step}"
+        )
+    elif freshness["age_seconds"] is None:
+        st.warning(f"⏳ Час отримання даних невідомий. {next_step}")
+    else:
+        st.warning(
+            f"⏳ Дані застарілі: отримано {format_age(freshness['age_seconds'])}. {next_step}"
+        )
+
+    if freshness["source_from_previous_day"]:
+        st.info(
+            f"📅 Графік на сайті опубліковано о {data.get('update_time')} "
+            "попереднього дня або раніше."
+        )
+
+
+@st.fragment(run_every=FRESHNESS_CHECK_INTERVAL)
+def watch_schedule_updates(rendered_signature):
+    """Індикатор свіжості, що оновлюється сам.
+
+    Вік даних і стан фонового оновлення перемальовуються у фрагменті,
+    а вся сторінка перезапускається лише коли у файлі з'явились інші дані.
+    """
+    data = load_schedule_data()
+    if data_signature(data) != rendered_signature:
+        st.rerun()
+
+    freshness = get_freshness(data)
+    if freshness["is_stale"] and start_revalidation():
+        freshness["is_revalidating"] = True
+
+    render_freshness(data, freshness)
+
+
 # ──────────────────────────────────────────────
 # Візуалізація та таблиці
 # ──────────────────────────────────────────────
@@ -371,91 +668,13 @@ def main():
         st.header("⚙️ Налаштування")
 
         if st.button("🔄 Оновити дані з сайту", type="primary"):
-            progress_placeholder = st.empty()
-            status_placeholder = st.empty()
-            emoji_placeholder = st.empty()
-
-            old_stderr = sys.stderr
-            sys.stderr = StringIO()
-
-            try:
-                with progress_placeholder.container():
-                    progress_bar = st.progress(0)
-
-                    # Крок 1: Підключення
-                    emoji_placeholder.markdown("### 🌐")
-                    status_placeholder.info("🌐 Підключення до сайту Львівобленерго...")
-                    progress_bar.progress(20)
-
-                    url = "https://poweron.loe.lviv.ua/"
-                    html = get_dynamic_html(url)
-
-                    # ── Мережева помилка: сайт взагалі недоступний ──
-                    if html is None:
-                        emoji_placeholder.markdown("### ⚠️")
-                        progress_bar.progress(60)
-                        status_placeholder.warning(
-                            "⚠️ Сайт недоступний. "
-                            "Припускаємо, що електроенергія є у всіх групах."
-                        )
-                        data = make_all_power_on_data()
-
-                    else:
-                        # Крок 2: Завантаження HTML
-                        emoji_placeholder.markdown("### 📥")
-                        status_placeholder.info("📥 Завантаження графіків відключень...")
-                        progress_bar.progress(50)
-
-                        # Крок 3: Парсинг
-                        emoji_placeholder.markdown("### 🔍")
-                        status_placeholder.info("🔍 Аналіз даних по групах...")
-                        progress_bar.progress(70)
-
-                        data = parse_html_to_data(html)
-
-                        # Визначаємо, чи спрацював фолбек всередині parse_html_to_data.
-                        # Якщо всі групи мають порожній список і структура сайту відома —
-                        # це може бути фолбек. Але ми не можемо відрізнити "дійсно немає
-                        # відключень" від "фолбек", тому просто показуємо результат.
-
-                    # Крок 4: Збереження (завжди, навіть для фолбеку)
-                    emoji_placeholder.markdown("### 💾")
-                    status_placeholder.info("💾 Збереження оновлених даних...")
-                    progress_bar.progress(90)
-
-                    with open('schedule.json', 'w', encoding='utf-8') as f:
-                        json.dump(data, f, ensure_ascii=False, indent=4)
-
-                    # Крок 5: Завершено
-                    emoji_placeholder.markdown("### ✅")
-                    progress_bar.progress(100)
-
-                    groups_count = len(data["schedules"])
-                    groups_with_power = sum(
-                        1 for v in data["schedules"].values() if not v
-                    )
-
-                    if html is None:
-                        # Повідомлення вже показано вище як warning
-                        pass
-                    else:
-                        status_placeholder.success(
-                            f"✅ Готово! Завантажено графіки для {groups_count} груп. "
-                            + (
-                                f"⚡ {groups_with_power} груп зі світлом весь день. "
-                                if groups_with_power > 0 else ""
-                            )
-                            + f"Дані актуальні станом на {data['update_time']}"
-                        )
-
-                    import time
-                    time.sleep(3)
-                    progress_placeholder.empty()
-                    status_placeholder.empty()
-                    emoji_placeholder.empty()
-
-            finally:
-                sys.stderr = old_stderr
+            if start_revalidation(force=True):
+                st.info(
+                    "🌐 Оновлення з сайту Львівобленерго запущено у фоні. "
+                    "Поточні дані залишаються доступними."
+                )
+            else:
+                st.info("⏳ Оновлення вже виконується у фоні.")
 
         st.markdown("---")
 
@@ -473,10 +692,10 @@ def main():
         st.session_state.selected_groups = selected_groups
 
     # ── Основний контент ──
-    if os.path.exists('schedule.json'):
-        with open('schedule.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
+    data, freshness = get_schedule()
+    watch_schedule_updates(data_signature(data))
 
+    if data is not None:
         update_time = data.get("update_time", "Невідомо")
 
         col1, col2, col3 = st.columns(3)
@@ -579,8 +798,10 @@ def main():
             if not stats_df.empty:
                 col_left, col_right = st.columns([1, 3])
                 with col_left:
-                    with open('schedule.json', 'r', encoding='utf-8') as f:
-                        json_data = f.read()
+                    json_data = json.dumps(
+                        {**data, "freshness": freshness},
+                        ensure_ascii=False, indent=4
+                    )
 
                     st.download_button(
                         label="📥 Завантажити дані (JSON)",
@@ -633,12 +854,6 @@ def main():
             else:
                 st.info("Немає даних для відображення статистики")
 
-    else:
-        st.warning(
-            "⚠️ Файл з даними не знайдено. "
-            "Натисніть 'Оновити дані з сайту' у бічній панелі."
-        )
-
     st.markdown("---")
     st.markdown(
         """